@@ -24,7 +24,7 @@ def index(data_dir, outdir, model, doc_id_to_inst_id, inst_id_to_target_pos, bar
     index_dict = {}
 
     replacements_dir = os.path.join(data_dir, '../replacements')
-    all_files = set([f"{file.split('-')[0]}-{file.split('-')[1]}" for file in os.listdir(replacements_dir)])
+    all_files = set([f"{file.split('-')[0]}-{file.split('-')[1]}" for file in os.listdir(replacements_dir) if file.endswith('.npy')])
 
     for filename in tqdm(all_files):
         base_path = os.path.join(replacements_dir, filename)
@@ -62,7 +62,7 @@ def index(tokenizer, data_dir, outdir, model, doc_id_to_inst_id, inst_id_to_word
                 token_to_index = tokenizer.encode(lemma, add_special_tokens=False) #Checked, this is alright.
             token_to_index = token_to_index[0]
 
-            pos = np.where(file_tokens[length_sum:length_sum + curr_len] == token_to_index)[0] + length_sum
+            pos = np.where(file_tokens[length_sum:length_sum + int(curr_len)] == token_to_index)[0] + length_sum
             pos = pos[which_target]
 
             valid_position = int(pos)
@@ -74,7 +74,7 @@ def index(tokenizer, data_dir, outdir, model, doc_id_to_inst_id, inst_id_to_word
                     index_dict[lemma][filename] = [valid_position]
                 else:
                     index_dict[lemma][filename].append(valid_position)
-            length_sum += curr_len
+            length_sum += int(curr_len)
 
     for token, positions in index_dict.items():
         token_outfile = os.path.join(outdir, f"{token}.jsonl")
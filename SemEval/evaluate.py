@@ -163,33 +163,46 @@ def single_lemma_comm_detection(lemma, data_dir, model_hf_path, n_reps, args, to
     return lemma_labeling
 
 def bow_hierarchical_linkage_labelling(args, data_dir, lemmas, instance_id_to_doc_id, voting_method):
+    labeling = {}
     model_hf_path, n_reps = args.model_hf_path, args.n_reps
-    model = MyBOWHierarchicalLinkage()
     doc_id_to_inst_id = {v:k for k,v in instance_id_to_doc_id.items()}
 
     tokenizer = AutoTokenizer.from_pretrained(model_hf_path, use_fast=True)
 
-    labeling = {}
-    # for lemma in tqdm(lemmas):
-    for lemma in lemmas:
-        rep_instances, _ = read_files(lemma,
-            data_dir,
-            sample_n_instances=-1,
-            special_tokens=SpecialTokens(model_hf_path),
-            should_lemmatize=True,
-            instance_attributes=['doc_ids', 'reps', 'tokens'],
-            bar=lambda x: x)
-        rep_instances.populate_specific_size(n_reps)
-        if args.remove_query_word or args.remove_stop_words:
-            rep_instances.remove_certain_words(args.remove_query_word, args.remove_stop_words, tokenizer, lemma)
-        doc_ids = [inst.doc_id for inst in rep_instances.data]
-        clusters = model.fit_predict(rep_instances)
-        for doc_id, cluster in zip(doc_ids, clusters):
-            lemma_inst_id = doc_id_to_inst_id[doc_id]
-            labeling[lemma_inst_id] = {cluster: 1}
+    partial_single_lemma_bow_hierarchical_linkage = partial(single_lemma_bow_hierarchical_linkage,
+        data_dir=data_dir,
+        model_hf_path=model_hf_path,
+        n_reps=n_reps,
+        args=args,
+        tokenizer=tokenizer,
+        doc_id_to_inst_id=doc_id_to_inst_id)
 
+    with Pool(cpu_count()) as p:
+        imap_it = tqdm(p.imap(partial_single_lemma_bow_hierarchical_linkage, lemmas), total=len(lemmas))
+        for lemma_labeling in imap_it:
+            labeling.update(lemma_labeling)
     return labeling
 
+def single_lemma_bow_hierarchical_linkage(lemma, data_dir, model_hf_path, n_reps, args, tokenizer, doc_id_to_inst_id):
+    rep_instances, _ = read_files(lemma,
+        data_dir,
+        sample_n_instances=-1,
+        special_tokens=SpecialTokens(model_hf_path),
+        should_lemmatize=True,
+        instance_attributes=['doc_ids', 'reps', 'tokens'],
+        bar=lambda x: x)
+    rep_instances.populate_specific_size(n_reps)
+    if args.remove_query_word or args.remove_stop_words:
+        rep_instances.remove_certain_words(args.remove_query_word, args.remove_stop_words, tokenizer, lemma)
+    doc_ids = [inst.doc_id for inst in rep_instances.data]
+    clusters = MyBOWHierarchicalLinkage().fit_predict(rep_instances)
+
+    lemma_labeling = {}
+    for doc_id, cluster in zip(doc_ids, clusters):
+        lemma_inst_id = doc_id_to_inst_id[doc_id]
+        lemma_labeling[lemma_inst_id] = {cluster: 1}
+    return lemma_labeling
+
 def label(args, data_dir, voting_method):
     if args.labeling_alg == 'clustering':
         labeling_alg = bow_hierarchical_linkage_labelling
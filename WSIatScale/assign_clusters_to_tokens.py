@@ -52,6 +52,8 @@ def find_and_write(filename, args, special_tokens, replacements_dir):
 def data_files(replacements_dir):
     files = set()
     for file in os.listdir(replacements_dir):
+        if not file.endswith('.npy'):
+            continue
         splits = file.split('-')
         files.add(f"{splits[0]}-{splits[1]}")
     
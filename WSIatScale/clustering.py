@@ -1,13 +1,10 @@
 # pylint: disable=no-member
-from collections import Counter, defaultdict
-
 from scipy.cluster.hierarchy import linkage, fcluster
-from scipy.spatial.distance import pdist, cdist
+from scipy.sparse import csr_matrix, issparse
 
 import numpy as np
 
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.preprocessing import normalize
 
 class ClusterFactory():
     @staticmethod
@@ -32,14 +29,13 @@ class ClusterFactory():
         sorted_clustered_rep_instances, sorted_average_sents = zip(*sorted_zipped)
         top_clustered_rep_instances = sorted_clustered_rep_instances[:show_top_n_clusters]
         for i, cluster_rep_instances in enumerate(top_clustered_rep_instances):
-            words_in_cluster = Counter()
-            for rep_instance in cluster_rep_instances:
-                for rep in rep_instance.reps:
-                    words_in_cluster[rep] += 1
+            reps = np.concatenate([np.asarray(rep_instance.reps) for rep_instance in cluster_rep_instances])
+            unique_reps, counts = np.unique(reps, return_counts=True)
             msg = {'header': f"Cluster {i}",
                    'found': f"Found total {len(cluster_rep_instances)} matches"}
-            words_in_cluster = words_in_cluster.most_common(show_top_n_words_per_cluster)
-            words_in_cluster = [(tokenizer.decode([t]), c) for t, c in words_in_cluster]
+            words_in_cluster = ClusterFactory.most_common_reps(unique_reps, counts, show_top_n_words_per_cluster)
+            decoded_words = tokenizer.batch_decode([[t] for t, _ in words_in_cluster])
+            words_in_cluster = [(w, c) for w, (_, c) in zip(decoded_words, words_in_cluster)]
 
             yield words_in_cluster, sorted_average_sents[i], msg
 
@@ -48,6 +44,12 @@ class ClusterFactory():
                    'found': ''}
             yield None, None, msg
 
+    @staticmethod
+    def most_common_reps(unique_reps, counts, n):
+        # unique_reps is sorted, so the stable sort breaks count ties by token id.
+        top_indices = np.argsort(-counts, kind='stable')[:max(n, 0)]
+        return list(zip(unique_reps[top_indices].tolist(), counts[top_indices].tolist()))
+
 class MyBOWHierarchicalLinkage(ClusterFactory):
     #This can possibly have a rewrite. Too many loops.
     def __init__(self):
@@ -58,13 +60,17 @@ class MyBOWHierarchicalLinkage(ClusterFactory):
         self.min_sense_instances = 2
 
     def fit_predict(self, rep_instances):
+        if len(rep_instances.data) < 2 * self.min_sense_instances:
+            # At most one sense can reach min_sense_instances, so everything is merged into it.
+            return np.zeros(len(rep_instances.data), dtype=np.int64)
+
         labels, rep_mat = self.get_initial_labels(rep_instances)
         n_senses = np.max(labels) + 1
         sense_means = self.find_sense_means(n_senses, rep_mat, labels)
 
         big_senses = self.find_big_senses(labels)
 
-        labels = self.merge_small_senses(sense_means, n_senses, big_senses, labels)
+        labels = self.merge_small_senses(sense_means, big_senses, labels)
 
         return labels
 
@@ -83,50 +89,72 @@ class MyBOWHierarchicalLinkage(ClusterFactory):
         return out
 
     def get_initial_labels(self, rep_instances):
-        #TODO can I do this without creating a dict?
-        reps_dict = [{r: 1 for r in rep_instance.reps} for rep_instance in rep_instances.data]
-        dict_vectorizer = DictVectorizer(sparse=False)
-        rep_mat = dict_vectorizer.fit_transform(reps_dict)
+        rep_mat = self.bag_of_reps(rep_instances)
         if self.use_tfidf:
-            rep_mat = TfidfTransformer(norm=None).fit_transform(rep_mat).todense()
+            self.scale_by_idf(rep_mat)
 
-        condensed_distance_mat = pdist(rep_mat, metric=self.metric)
+        distance_mat = self.cosine_distances(rep_mat)
+        condensed_distance_mat = distance_mat[np.triu_indices(len(distance_mat), k=1)]
         hierarchical_linkage = linkage(condensed_distance_mat, method=self.method, metric=self.metric)
         max_number_senses = min(self.max_number_senses, len(rep_instances.data) - 1)
         distance_threshold = hierarchical_linkage[-max_number_senses, 2]
         labels = fcluster(hierarchical_linkage, distance_threshold, 'distance') - 1
         return labels, rep_mat
 
-    def merge_small_senses(self, sense_means, n_senses, big_senses, labels):
-        if self.min_sense_instances <= 0:
-            return {x:x for x in range(n_senses)}, labels
-        
-        sense_remapping = {}
-        distance_mat = cdist(sense_means, sense_means, metric='cosine')
-        closest_senses = np.argsort(distance_mat, )[:, ]
+    @staticmethod
+    def bag_of_reps(rep_instances):
+        all_reps = np.concatenate([np.asarray(rep_instance.reps, dtype=np.int64) for rep_instance in rep_instances.data])
+        vocab, indices = np.unique(all_reps, return_inverse=True)
+        indptr = np.zeros(len(rep_instances.data) + 1, dtype=np.int64)
+        np.cumsum([len(rep_instance.reps) for rep_instance in rep_instances.data], out=indptr[1:])
+        rep_mat = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(rep_instances.data), len(vocab)))
+        # A rep appearing twice in the same instance still counts once.
+        rep_mat.sum_duplicates()
+        rep_mat.data[:] = 1
+        return rep_mat
 
-        for sense_idx in range(n_senses):
-            for closest_sense in closest_senses[sense_idx]:
-                if closest_sense in big_senses:
-                    sense_remapping[sense_idx] = closest_sense
-                    break
+    @staticmethod
+    def scale_by_idf(rep_mat):
+        # Same smoothed idf as TfidfTransformer(norm=None), applied in place to the CSR data.
+        n_instances, vocab_size = rep_mat.shape
+        document_frequency = np.bincount(rep_mat.indices, minlength=vocab_size)
+        idf = np.log((1 + n_instances) / (1 + document_frequency)) + 1
+        rep_mat.data *= idf[rep_mat.indices]
 
-        continuous_mapping = {original_sense_idx: new_sense_idx for original_sense_idx, new_sense_idx in zip(sorted(big_senses), range(len(big_senses)))}
-        labels = np.array([continuous_mapping[sense_remapping[x]] for x in labels])
+    @staticmethod
+    def cosine_distances(mat):
+        normalized = normalize(mat)
+        similarities = normalized @ normalized.T
+        if issparse(similarities):
+            similarities = similarities.toarray()
+        distance_mat = 1 - similarities
+        np.clip(distance_mat, 0, 2, out=distance_mat)
+        np.fill_diagonal(distance_mat, 0)
+        return distance_mat
+
+    def merge_small_senses(self, sense_means, big_senses, labels):
+        if self.min_sense_instances <= 0:
+            return labels
+
+        # Only similarities to big senses are needed; the argmax is already the continuous big-sense index.
+        normalized_means = normalize(sense_means)
+        similarities_to_big_senses = normalized_means @ normalized_means[big_senses].T
+        closest_big_senses = similarities_to_big_senses.argmax(axis=1)
+        closest_big_senses[big_senses] = np.arange(len(big_senses))
+        labels = closest_big_senses[labels]
 
         return labels
 
     def find_big_senses(self, labels):
-        sense_counter = Counter(labels)
-
-        big_senses = [x for x in sense_counter if sense_counter[x] >= self.min_sense_instances]
+        sense_sizes = np.bincount(labels)
+        big_senses = np.flatnonzero(sense_sizes >= self.min_sense_instances)
         return big_senses
 
     @staticmethod
     def find_sense_means(n_senses, transformed, labels):
-        sense_means = np.zeros((n_senses, transformed.shape[1]))
-        for sense_idx in range(n_senses):
-            instances_in_sense = np.where(labels == sense_idx)
-            cluster_center = np.mean(np.array(transformed)[instances_in_sense], 0)
-            sense_means[sense_idx] = cluster_center
-        return sense_means
+        sense_indicator = csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))), shape=(n_senses, len(labels)))
+        sense_sums = sense_indicator @ transformed
+        if issparse(sense_sums):
+            sense_sums = sense_sums.toarray()
+        sense_means = sense_sums / np.bincount(labels, minlength=n_senses)[:, None]
+        return sense_means
\ No newline at end of file
@@ -286,6 +286,7 @@ def find_paragraph_and_positions(token_positions, tokens, lengths):
     token_positions = np.array(token_positions)
     length_sum = 0
     for length in lengths:
+        length = int(length)
         token_pos = token_positions[np.where(np.logical_and(token_positions >= length_sum, token_positions < length_sum + length))[0]]
         if len(token_pos) > 0:
             yield tokens[length_sum:length_sum + length], token_pos-length_sum, token_pos
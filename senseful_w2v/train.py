@@ -51,7 +51,7 @@ class DatasetIterator:
         self.special_tokens = special_tokens
         self.processed_sents_cache_dir = processed_sents_cache_dir
 
-        self.filenames = [f.name.split('-tokens.npy')[0] for f in self.replacements_dir().iterdir() if 'tokens' in f.name]
+        self.filenames = [f.name.split('-tokens.npy')[0] for f in self.replacements_dir().iterdir() if f.name.endswith('-tokens.npy')]
         for filename in self.filenames:
             assert self.senses_file(filename).exists()
 
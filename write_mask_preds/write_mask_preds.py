@@ -1,9 +1,11 @@
  # pylint: disable=import-error
 import argparse
+from collections import defaultdict
 import json
 import os
 
 import numpy as np
+from numpy.lib.format import open_memmap
 import torch
 from tqdm import tqdm
 
@@ -20,6 +22,7 @@ REPS_DIR = 'replacements'
 
 TOP_N_WORDS = 100 + 1 #removing identity replacement
 PAD_ID = 0
+LOGSUMEXP_CHUNK_ROWS = 1024
 dataset_params = {'cord': {'dataset_class': CORDDataset},
     'wiki': {'dataset_class': WikiDataset},
     'SemEval2010': {'dataset_class': SemEval2010Dataset}, # Should be write_specific_replacements as well
@@ -35,25 +38,40 @@ def main(args):
     tokenizer, model = initialize_models(device, args)
     dataset_class = dataset_params[args.dataset]['dataset_class']
 
+    writer = AsyncReplacementsWriter(device)
     i = 0
     files = read_files_with_conditions(args)
     for input_file in tqdm(files):
         dataset = dataset_class(args, input_file, tokenizer, cache_dir='/tmp/')
-        dataloader = simple_dataloader(args, dataset) if args.simple_sampler else adaptive_dataloader(args, dataset)
+        dataloader = simple_dataloader(args, dataset, device) if args.simple_sampler else adaptive_dataloader(args, dataset, device)
 
         for inputs in tqdm(dataloader):
-            with torch.no_grad():
+            with torch.inference_mode():
                 dict_to_device(inputs, device)
                 doc_ids = inputs.pop('guid')
-                last_hidden_states = model(**inputs)[0]
-                normalized = last_hidden_states.softmax(-1)
-                probs, indices = normalized.topk(TOP_N_WORDS)
+                # With --fp16 the weights are already half and autocast keeps layer norm and softmax in fp32; otherwise it is a no-op.
+                with torch.autocast(device.type, dtype=torch.float16, enabled=args.fp16):
+                    last_hidden_states = model(**inputs)[0]
+                writer.flush() # Writing the previous batch while the GPU runs this forward pass.
 
                 if args.write_specific_replacements:
+                    probs, indices = top_n_probs(last_hidden_states)
                     write_specific_replacements_to_files(args.out_dir, doc_ids, inputs, indices, probs)
                 else:
-                    write_replacements_to_file(os.path.join(args.out_dir, REPS_DIR, f"{input_file.split('.')[0]}-{i}.npz"), doc_ids, inputs, indices, probs)
+                    probs, indices = top_n_probs(last_hidden_states[inputs['attention_mask'].bool()])
+                    write_replacements_to_file(writer, os.path.join(args.out_dir, REPS_DIR, f"{input_file.split('.')[0]}-{i}.npz"), doc_ids, inputs, indices, probs)
             i += 1
+    writer.flush()
+
+def top_n_probs(logits):
+    # Softmax is monotonic, so take the top logits first and normalize only those against the full row.
+    # Keep topk sorted: the identity fallback drops the last column and readers truncate reps[:n_reps].
+    top_logits, indices = logits.topk(TOP_N_WORDS)
+    # With fp16 logits the logsumexp runs in fp32 a chunk of rows at a time, never materializing a full fp32 copy.
+    flat_logits = logits.reshape(-1, logits.shape[-1])
+    log_normalizers = torch.cat([chunk.float().logsumexp(-1) for chunk in flat_logits.split(LOGSUMEXP_CHUNK_ROWS)])
+    probs = (top_logits.float() - log_normalizers.view(*logits.shape[:-1], 1)).exp()
+    return probs, indices
 
 def read_files_with_conditions(args):
     def files_in_range(f, files_range):
@@ -79,23 +97,24 @@ def initialize_models(device, args):
     model = model_class.from_pretrained(model_hf_path)
     model.to(device)
     if args.fp16:
-        from apex import amp # pylint: disable=import-error
-        model = amp.initialize(model, opt_level="O2")
+        model.half()
 
     assert tokenizer.vocab_size < 65535 # Saving pred_ids as np.uint16
     return tokenizer, model
 
-def adaptive_dataloader(args, dataset):
+def adaptive_dataloader(args, dataset, device):
     sampler = MaxTokensBatchSampler(dataset, max_tokens=args.max_tokens_per_batch, padding_noise=0.0)
     dataloader = DataLoader(
         dataset,
         batch_size=args.batch_size,
         sampler=sampler,
         collate_fn=data_collator_for_adaptive_sampler,
+        num_workers=args.num_workers,
+        pin_memory=device.type == 'cuda',
     )
     return dataloader
 
-def simple_dataloader(args, dataset):
+def simple_dataloader(args, dataset, device):
     sampler = (
         RandomSampler(dataset)
         if args.local_rank == -1
@@ -107,6 +126,8 @@ def simple_dataloader(args, dataset):
         batch_size=args.batch_size,
         sampler=sampler,
         collate_fn=default_data_collator,
+        num_workers=args.num_workers,
+        pin_memory=device.type == 'cuda',
     )
     return dataloader
 
@@ -117,15 +138,13 @@ def write_specific_replacements_to_files(out_dir, doc_ids, inputs, replacements,
         relevant_reps = reps[relevant_index][:TOP_N_WORDS-1]
 
         outfile = os.path.join(out_dir, REPS_DIR, f"{doc_id}-reps.npy")
-        np.save(outfile, relevant_reps.cpu().numpy().astype(np.uint16))
+        np.save(outfile, to_uint16_numpy(relevant_reps))
 
-def write_replacements_to_file(outfile, doc_ids, inputs, replacements, probs):
+def write_replacements_to_file(writer, outfile, doc_ids, inputs, replacements, probs):
     attention_mask = inputs['attention_mask'].bool()
 
     sent_lengths = inputs['attention_mask'].sum(1)
     tokens = inputs['input_ids'].masked_select(attention_mask)
-    replacements = replacements.masked_select(attention_mask.unsqueeze(2)).view(-1, TOP_N_WORDS)
-    probs = probs.masked_select(attention_mask.unsqueeze(2)).view(-1, TOP_N_WORDS)
 
     identity_replacements = replacements == tokens.unsqueeze(1)
     has_identity_replacements = identity_replacements.sum(1) == 0
@@ -134,17 +153,117 @@ def write_replacements_to_file(outfile, doc_ids, inputs, replacements, probs):
     probs_without_identity = probs.masked_select(~identity_replacements).view(-1, TOP_N_WORDS-1)
     normalized_probs_without_identity = probs_without_identity/probs_without_identity.sum(1).unsqueeze(1)
 
-    np.save(f"{outfile}-tokens.npy", tokens.cpu().numpy().astype(np.uint16))
-    np.save(f"{outfile}-lengths.npy", sent_lengths.cpu().numpy().astype(np.int16))
-    np.save(f"{outfile}-reps.npy", reps_without_identity.cpu().numpy().astype(np.uint16))
-    np.save(f"{outfile}-probs.npy", normalized_probs_without_identity.cpu().numpy().astype(np.float16))
-    np.save(f"{outfile}-doc_ids.npy", doc_ids.cpu().numpy().astype(np.int32))
+    replacements_file = ReplacementsFile(outfile, n_sents=len(sent_lengths), n_tokens=len(tokens))
+    writer.write(replacements_file, {'tokens': tokens.to(torch.int16),
+                                     'lengths': sent_lengths.to(torch.int16),
+                                     'reps': reps_without_identity.to(torch.int16),
+                                     'probs': normalized_probs_without_identity.to(torch.float16),
+                                     'doc_ids': doc_ids.to(torch.int32)})
+
+def to_uint16_numpy(tensor):
+    # torch has no uint16, so narrow to int16 on the device and reinterpret the bits on the host.
+    return tensor.to(torch.int16).cpu().numpy().view(np.uint16)
+
+class ReplacementsFile():
+    """
+    The .npy files of one batch, one per stream (tokens, lengths, reps, probs, doc_ids).
+    Files stay batch sized on purpose: the inverted index, cluster assignment and
+    `sample_instances` all work per file. Streams are written under a `.tmp` suffix and
+    only renamed to their final names by `close` once completely filled, so an interrupted
+    run leaves no zero-padded files behind for the indexers to pick up.
+    """
+    streams = {'tokens': np.uint16, 'lengths': np.int16, 'reps': np.uint16, 'probs': np.float16, 'doc_ids': np.int32}
+
+    def __init__(self, outfile, n_sents, n_tokens):
+        shapes = {'tokens': (n_tokens,),
+                  'lengths': (n_sents,),
+                  'reps': (n_tokens, TOP_N_WORDS-1),
+                  'probs': (n_tokens, TOP_N_WORDS-1),
+                  'doc_ids': (n_sents,)}
+        self.paths = {name: f"{outfile}-{name}.npy" for name in self.streams}
+        self.arrays = {name: open_memmap(f"{self.paths[name]}.tmp", mode='w+', dtype=dtype, shape=shapes[name])
+                       for name, dtype in self.streams.items()}
+        self.offsets = {name: 0 for name in self.arrays}
+
+    def append(self, name, array):
+        # Arrays come in as int16 for the uint16 streams since torch has no uint16.
+        offset = self.offsets[name]
+        self.arrays[name][offset:offset+len(array)] = array.view(self.arrays[name].dtype)
+        self.offsets[name] += len(array)
+
+    def close(self):
+        for name, array in self.arrays.items():
+            assert self.offsets[name] == len(array), f"Wrote {self.offsets[name]} of {len(array)} {name}"
+            array.flush()
+        self.arrays = None
+        for path in self.paths.values():
+            os.replace(f"{path}.tmp", path)
+
+class AsyncReplacementsWriter():
+    """
+    Copies a batch's tensors to pinned host memory on a side CUDA stream and only writes
+    and closes their `ReplacementsFile` on the next `flush`, so the device-to-host copy and
+    the disk write overlap with the following forward pass. Tensors sharing a dtype are packed
+    into a single copy, staged in one pinned buffer per dtype that is reused across batches
+    and only reallocated when a batch needs more room. On CPU tensors are appended right away.
+    """
+    def __init__(self, device):
+        self.copy_stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.host_buffers = {}
+        self.pending = None
+
+    def write(self, replacements_file, name_to_tensors):
+        self.flush()
+        if self.copy_stream is None:
+            for name, tensor in name_to_tensors.items():
+                replacements_file.append(name, tensor.numpy())
+            replacements_file.close()
+            return
+
+        tensors_by_dtype = defaultdict(list)
+        for name, tensor in name_to_tensors.items():
+            tensors_by_dtype[tensor.dtype].append((name, tensor))
+        packed_tensors = {dtype: torch.cat([tensor.reshape(-1) for _, tensor in named_tensors]) for dtype, named_tensors in tensors_by_dtype.items()}
+
+        self.copy_stream.wait_stream(torch.cuda.current_stream())
+        host_packs = []
+        with torch.cuda.stream(self.copy_stream):
+            for dtype, packed in packed_tensors.items():
+                packed.record_stream(self.copy_stream)
+                host_packed = self.host_buffer(dtype, packed.numel())[:packed.numel()]
+                host_packed.copy_(packed, non_blocking=True)
+                layout = [(name, tuple(tensor.shape)) for name, tensor in tensors_by_dtype[dtype]]
+                host_packs.append((host_packed, layout))
+            copied = torch.cuda.Event()
+            copied.record(self.copy_stream)
+        self.pending = (replacements_file, host_packs, copied)
+
+    def host_buffer(self, dtype, size):
+        # Safe to reuse: `write` flushes, and so finishes reading, the previous batch first.
+        if dtype not in self.host_buffers or self.host_buffers[dtype].numel() < size:
+            self.host_buffers[dtype] = torch.empty(size, dtype=dtype, pin_memory=True)
+        return self.host_buffers[dtype]
+
+    def flush(self):
+        if self.pending is None:
+            return
+        replacements_file, host_packs, copied = self.pending
+        copied.synchronize()
+        for host_packed, layout in host_packs:
+            packed = host_packed.numpy()
+            offset = 0
+            for name, shape in layout:
+                size = int(np.prod(shape))
+                replacements_file.append(name, packed[offset:offset+size].reshape(shape))
+                offset += size
+        replacements_file.close()
+        self.pending = None
 
 def dict_to_device(inputs, device):
     if device.type == 'cpu': return
     for k, v in inputs.items():
         if isinstance(v, torch.Tensor):
-            inputs[k] = v.to(device)
+            inputs[k] = v.to(device, non_blocking=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -157,6 +276,7 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, required=True, choices=['bert-large-cased-whole-word-masking', 'bert-large-uncased', 'RoBERTa', 'scibert'])
     parser.add_argument("--local_rank", type=int, default=-1, help="Not Maintained")
     parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_workers", type=int, default=0)
     parser.add_argument("--max_seq_length", type=int, default=512)
     parser.add_argument("--max_tokens_per_batch", type=int, default=-1)
     parser.add_argument("--no_input_file", action="store_true", help="Go over all files in one batch")